@@ -0,0 +1,82 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class AlertDebouncer:
+    """
+    Hold alerts per objectId, so that several alerts for the same object in quick
+    succession (eg. g and r in the same sequence) become one update.
+
+    An object is released once no new alert for it has arrived for `hold_time` sec,
+    or `max_delay` sec after its first held alert - whichever is first.
+    With hold_time=0 alerts pass straight through.
+
+    >>> debouncer = AlertDebouncer(hold_time=300, max_delay=900)
+    >>> debouncer.add(latest_alerts)
+    >>> ready_alerts = debouncer.pop_ready()
+
+    alerts are (topic, alert, key) tuples as from Listener.listen_for_alerts.
+    """
+
+    def __init__(self, hold_time=0., max_delay=900.):
+        self.hold_time = hold_time
+        self.max_delay = max_delay
+        self.pending = {}
+
+
+    def add(self, latest_alerts, now=None):
+        if now is None:
+            now = time.monotonic()
+        for topic, alert, key in latest_alerts:
+            objectId = alert["objectId"]
+            if objectId not in self.pending:
+                self.pending[objectId] = {"first_seen": now, "alerts": []}
+            self.pending[objectId]["last_seen"] = now
+            self.pending[objectId]["alerts"].append((topic, alert, key))
+
+
+    def pop_ready(self, now=None, flush=False):
+        if now is None:
+            now = time.monotonic()
+        ready = []
+        for objectId in list(self.pending.keys()):
+            entry = self.pending[objectId]
+            quiet = now - entry["last_seen"] >= self.hold_time
+            overdue = now - entry["first_seen"] >= self.max_delay
+            if flush or quiet or overdue:
+                self.pending.pop(objectId)
+                if len(entry["alerts"]) > 1:
+                    logger.info(f"merge {len(entry['alerts'])} alerts for {objectId}")
+                ready.append(self.merge_alerts(entry["alerts"]))
+        return ready
+
+
+    @staticmethod
+    def merge_alerts(alerts):
+        """
+        Combine alerts for one object into the latest one: the candidates of the
+        earlier alerts which aren't already in its prv_candidates go in "merged_candidates".
+
+        They're kept apart from prv_candidates (which is left as it came from fink)
+        so Listener.prepare_alert can still tell from prv_candidates alone whether
+        it needs to query the portal for the full history.
+        """
+        alerts = sorted(alerts, key=lambda x: x[1]["candidate"]["jd"])
+        topic, latest_alert, key = alerts[-1]
+        if len(alerts) == 1:
+            return topic, latest_alert, key
+
+        prv_candidates = latest_alert.get("prv_candidates") or []
+        known_candids = set(c.get("candid") for c in prv_candidates)
+        merged_candidates = []
+        for _, alert, _ in alerts[:-1]:
+            candidate = alert["candidate"]
+            if candidate.get("candid") not in known_candids:
+                merged_candidates.append(candidate)
+                known_candids.add(candidate.get("candid"))
+
+        merged_alert = dict(latest_alert)
+        merged_alert["merged_candidates"] = merged_candidates
+        return topic, merged_alert, key
@@ -0,0 +1,301 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+default_filter_lookup = {1: "g", 2: "r", 3: "i"}
+
+
+def _ragged_column(histories, col, lengths):
+    """
+    concatenate one column from each history into a single flat float array.
+    missing columns are filled with NaN, None becomes NaN.
+    """
+    arrays = []
+    for history, length in zip(histories, lengths):
+        if col in history:
+            arrays.append(np.asarray(history[col], dtype=float))
+        else:
+            arrays.append(np.full(length, np.nan))
+    if len(arrays) == 0:
+        return np.empty(0)
+    return np.concatenate(arrays)
+
+
+def _group_bounds(sorted_keys):
+    """
+    first and last index of each run of equal values in an already sorted array.
+    """
+    if len(sorted_keys) == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    boundary = np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1
+    starts = np.concatenate([[0], boundary])
+    ends = np.concatenate([boundary, [len(sorted_keys)]]) - 1
+    return starts, ends
+
+
+def _pair_nearest(obj_a, t_a, obj_b, t_b, max_gap):
+    """
+    for each point in a, index of the nearest point in b from the same object,
+    or -1 if there isn't one within max_gap.
+    """
+    pair = np.full(len(t_a), -1)
+    if len(t_a) == 0 or len(t_b) == 0:
+        return pair
+    # one sorted key for (object, time), spaced so different objects never look close.
+    t_min = min(t_a.min(), t_b.min())
+    spacing = max(t_a.max(), t_b.max()) - t_min + 10. * max_gap + 1.
+    key_a = obj_a * spacing + (t_a - t_min)
+    key_b = obj_b * spacing + (t_b - t_min)
+    order_b = np.argsort(key_b)
+    sorted_b = key_b[order_b]
+
+    right = np.clip(np.searchsorted(sorted_b, key_a), 0, len(sorted_b) - 1)
+    left = np.clip(right - 1, 0, len(sorted_b) - 1)
+    use_left = np.abs(sorted_b[left] - key_a) < np.abs(sorted_b[right] - key_a)
+    nearest = np.where(use_left, left, right)
+    close = np.abs(sorted_b[nearest] - key_a) <= max_gap
+    pair[close] = order_b[nearest[close]]
+    return pair
+
+
+def _significant_rate(dm, dt, sigma, min_baseline, n_sigma):
+    """
+    dm/dt (mag/day), or NaN if dt is shorter than min_baseline (days)
+    or |dm| isn't more than n_sigma * sigma - ie. the change could be noise.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        significant = (dt >= min_baseline) & (np.abs(dm) > n_sigma * sigma)
+        return np.where(significant, dm / dt, np.nan)
+
+
+def compute_lightcurve_features(
+    histories, object_ids=None, filter_lookup=None, t_ref=None, max_colour_gap=0.5,
+    min_baseline=0.5, n_sigma=3.
+):
+    """
+    Compute simple light curve features for many objects at once.
+
+    All of the histories are flattened into one set of ragged arrays
+    (plus an object index), so the work is a handful of sorts and ufunc
+    reductions, rather than a pandas groupby per object.
+
+    parameters
+    ----------
+    histories
+        list of DataFrames (or dicts of equal-length arrays) with columns `jd`, `magpsf`, `fid`.
+        rows with non-finite `magpsf` (ie. upper limits) are ignored.
+    object_ids [optional]
+        list of names, same length as histories. added as column `objectId`.
+    filter_lookup [optional]
+        dict of {fid: filter_name}. default {1: "g", 2: "r", 3: "i"}.
+    t_ref [optional]
+        jd (float or array, one per object) to measure `t_since_first` from.
+        defaults to the latest detection of each object.
+    max_colour_gap [optional]
+        g and r detections are only paired into a g-r colour if they're within
+        this many days of each other. default 0.5.
+    min_baseline, n_sigma [optional]
+        rates (and gr_rate) are NaN unless measured over at least min_baseline days
+        (default 0.5) and the change is more than n_sigma (default 3) combined
+        `sigmapsf` - otherwise two points taken an hour apart give huge noisy rates.
+        a missing `sigmapsf` counts as zero error.
+
+    returns
+    -------
+    features
+        DataFrame with one row per history (same order), columns:
+            n_det, t_first, t_last, t_since_first, peak_mag, peak_fid,
+            rise_rate_<f>, decline_rate_<f> for each filter (mag/day, positive
+            means brightening before peak/fading after peak),
+            gr_first, gr_last, gr_rate (mag/day, positive means reddening) - from
+            the first and last g detection which has an r detection nearby.
+    """
+    if filter_lookup is None:
+        filter_lookup = default_filter_lookup
+    n_obj = len(histories)
+
+    # len() of a dict is the number of keys, so count rows from the jd column.
+    lengths = np.array([len(h["jd"]) if "jd" in h else 0 for h in histories], dtype=int)
+    obj = np.repeat(np.arange(n_obj), lengths)
+    jd = _ragged_column(histories, "jd", lengths)
+    mag = _ragged_column(histories, "magpsf", lengths)
+    sig = np.nan_to_num(_ragged_column(histories, "sigmapsf", lengths), nan=0.)
+    fid = _ragged_column(histories, "fid", lengths)
+
+    fids = np.array(sorted(filter_lookup.keys()), dtype=float)
+    fi = np.searchsorted(fids, fid)
+    fi = np.minimum(fi, len(fids) - 1)
+    known_filter = fids[fi] == fid
+
+    detected = np.isfinite(mag) & np.isfinite(jd) & known_filter
+    obj, jd, mag, sig, fid, fi = (x[detected] for x in (obj, jd, mag, sig, fid, fi))
+
+    ## per-object quantities
+    n_det = np.bincount(obj, minlength=n_obj)
+    t_first = np.full(n_obj, np.inf)
+    np.minimum.at(t_first, obj, jd)
+    t_last = np.full(n_obj, -np.inf)
+    np.maximum.at(t_last, obj, jd)
+    peak_mag = np.full(n_obj, np.inf)
+    np.minimum.at(peak_mag, obj, mag)
+
+    peak_fid = np.full(n_obj, np.nan)
+    order = np.lexsort((mag, obj))
+    starts, _ = _group_bounds(obj[order])
+    peak_fid[obj[order][starts]] = fid[order][starts]
+
+    no_det = n_det == 0
+    t_first[no_det] = np.nan
+    t_last[no_det] = np.nan
+    peak_mag[no_det] = np.nan
+
+    if t_ref is None:
+        t_ref = t_last
+    t_since_first = np.asarray(t_ref, dtype=float) - t_first
+
+    ## per-(object, filter) quantities
+    n_f = len(fids)
+    group = obj * n_f + fi
+
+    order = np.lexsort((jd, group))
+    group_s, jd_s, mag_s, sig_s = group[order], jd[order], mag[order], sig[order]
+    starts, ends = _group_bounds(group_s)
+    group_ids = group_s[starts]
+    first_t, first_m, first_s = jd_s[starts], mag_s[starts], sig_s[starts]
+    last_t, last_m, last_s = jd_s[ends], mag_s[ends], sig_s[ends]
+
+    peak_order = np.lexsort((jd, mag, group)) # brightest, earliest first in each group
+    peak_starts, _ = _group_bounds(group[peak_order])
+    peak_t = jd[peak_order][peak_starts]
+    peak_m = mag[peak_order][peak_starts]
+    peak_s = sig[peak_order][peak_starts]
+
+    rise = _significant_rate(
+        first_m - peak_m, peak_t - first_t, np.hypot(first_s, peak_s), min_baseline, n_sigma
+    )
+    decline = _significant_rate(
+        last_m - peak_m, last_t - peak_t, np.hypot(last_s, peak_s), min_baseline, n_sigma
+    )
+
+    def _to_grid(values):
+        grid = np.full((n_obj, n_f), np.nan)
+        grid[group_ids // n_f, group_ids % n_f] = values
+        return grid
+
+    rise_grid = _to_grid(rise)
+    decline_grid = _to_grid(decline)
+
+    features = {}
+    if object_ids is not None:
+        features["objectId"] = list(object_ids)
+    features.update(
+        n_det=n_det, t_first=t_first, t_last=t_last, t_since_first=t_since_first,
+        peak_mag=peak_mag, peak_fid=peak_fid,
+    )
+    for jj, f in enumerate(fids):
+        filter_name = filter_lookup[int(f)]
+        features[f"rise_rate_{filter_name}"] = rise_grid[:, jj]
+        features[f"decline_rate_{filter_name}"] = decline_grid[:, jj]
+
+    ## colour evolution: pair each g detection with the nearest r detection (same object).
+    gr_first = np.full(n_obj, np.nan)
+    gr_last = np.full(n_obj, np.nan)
+    gr_rate = np.full(n_obj, np.nan)
+    filter_index = {name: jj for jj, name in enumerate(filter_lookup[int(f)] for f in fids)}
+    if "g" in filter_index and "r" in filter_index:
+        is_g = fi == filter_index["g"]
+        is_r = fi == filter_index["r"]
+        pair = _pair_nearest(obj[is_g], jd[is_g], obj[is_r], jd[is_r], max_colour_gap)
+        paired = pair >= 0
+        colour_obj = obj[is_g][paired]
+        colour_t = 0.5 * (jd[is_g][paired] + jd[is_r][pair[paired]])
+        colour = mag[is_g][paired] - mag[is_r][pair[paired]]
+        colour_s = np.hypot(sig[is_g][paired], sig[is_r][pair[paired]])
+
+        order = np.lexsort((colour_t, colour_obj))
+        colour_obj, colour_t = colour_obj[order], colour_t[order]
+        colour, colour_s = colour[order], colour_s[order]
+        starts, ends = _group_bounds(colour_obj)
+        colour_ids = colour_obj[starts]
+        gr_first[colour_ids] = colour[starts]
+        gr_last[colour_ids] = colour[ends]
+        gr_rate[colour_ids] = _significant_rate(
+            colour[ends] - colour[starts], colour_t[ends] - colour_t[starts],
+            np.hypot(colour_s[starts], colour_s[ends]), min_baseline, n_sigma
+        )
+    features.update(gr_first=gr_first, gr_last=gr_last, gr_rate=gr_rate)
+
+    return pd.DataFrame(features)
+
+
+def kilonova_score(features):
+    """
+    Crude "how fast is it evolving" score - kilonovae rise and fade by
+    ~0.3-1 mag/day and redden quickly, SNe evolve by <~0.1 mag/day.
+    Sum of the fastest rise, the fastest decline and any reddening (mag/day).
+    Missing features count as zero.
+    """
+    rise_cols = [c for c in features.columns if c.startswith("rise_rate_")]
+    decline_cols = [c for c in features.columns if c.startswith("decline_rate_")]
+
+    def _fastest(cols):
+        if len(cols) == 0:
+            return np.zeros(len(features))
+        values = np.clip(features[cols].values, 0, None)
+        values = np.where(np.isfinite(values), values, 0.)
+        return values.max(axis=1)
+
+    reddening = np.clip(np.nan_to_num(features["gr_rate"].values, nan=0.), 0, None)
+    return _fastest(rise_cols) + _fastest(decline_cols) + reddening
+
+
+def rank_candidates(features, max_age=10.):
+    """
+    Order (indices into features) to process candidates in, best first.
+    Objects first detected within `max_age` days go ahead of older ones,
+    then sort by `kilonova_score`.
+    """
+    score = kilonova_score(features)
+    age = features["t_since_first"].values
+    is_young = np.isfinite(age) & (age <= max_age)
+    return np.lexsort((-score, ~is_young))
+
+
+def format_features(obj_features, filter_lookup=None):
+    """
+    Short text summary of one row of `compute_lightcurve_features`, for messages.
+    """
+    if filter_lookup is None:
+        filter_lookup = default_filter_lookup
+
+    lines = []
+    peak_mag = obj_features.get("peak_mag", np.nan)
+    if np.isfinite(peak_mag):
+        peak_filter = filter_lookup.get(int(obj_features["peak_fid"]), "?")
+        lines.append(
+            f"peak mag {peak_mag:.2f} ({peak_filter}), "
+            f"{obj_features['t_since_first']:.1f} days since first det."
+        )
+    for filter_name in filter_lookup.values():
+        rise = obj_features.get(f"rise_rate_{filter_name}", np.nan)
+        decline = obj_features.get(f"decline_rate_{filter_name}", np.nan)
+        rates = []
+        if np.isfinite(rise):
+            rates.append(f"rise {rise:.2f}")
+        if np.isfinite(decline):
+            rates.append(f"decline {decline:.2f}")
+        if len(rates) > 0:
+            lines.append(f"{filter_name}: " + ", ".join(rates) + " mag/day")
+    gr_last = obj_features.get("gr_last", np.nan)
+    if np.isfinite(gr_last):
+        gr_line = f"g-r = {gr_last:.2f}"
+        gr_rate = obj_features.get("gr_rate", np.nan)
+        if np.isfinite(gr_rate):
+            gr_line = gr_line + f" ({gr_rate:+.2f} mag/day)"
+        lines.append(gr_line)
+    if "score" in obj_features:
+        lines.append(f"evolution score {obj_features['score']:.2f}")
+    return "\n".join(lines)
@@ -1,6 +1,7 @@
 import datetime
 import json
 import logging
+import signal
 import time
 import traceback
 import urllib
@@ -12,15 +13,27 @@ import pandas as pd
 
 import matplotlib.pyplot as plt
 
-from telegram import Bot
+from telegram import Bot, InputMediaPhoto
 from astropy.coordinates import EarthLocation, SkyCoord
 from astropy.time import Time
 
 from fink_client.avroUtils import write_alert, _get_alert_schema
 from fink_client.consumer import AlertConsumer
 
+from dk154_kn_targets.debounce import AlertDebouncer
 from dk154_kn_targets.fink_query import FinkQuery
-from dk154_kn_targets.plotting import plot_lightcurve, readstamp, plot_observing_chart
+from dk154_kn_targets.lightcurve_features import (
+    compute_lightcurve_features, default_filter_lookup, format_features,
+    kilonova_score, rank_candidates
+)
+from dk154_kn_targets.observing_windows import (
+    format_windows, get_night_table, target_observable_windows
+)
+from dk154_kn_targets.profiling import AlertProfiler
+from dk154_kn_targets.plotting import (
+    plot_lightcurve, readstamp, plot_observing_chart, combine_images
+)
+from dk154_kn_targets.workers import WorkerSupervisor, WorkerTaskError
 
 from dk154_kn_targets import paths
 
@@ -29,6 +42,18 @@ from dk154_kn_targets import paths
 logger = logging.getLogger(__name__)
 
 _telegram_admin_path = paths.config_path / "telegram_admin.yaml"
+_ztf_config_path = paths.config_path / "ztf.yaml"
+
+default_media_config = {
+    "format": "png",
+    "dpi": 100,
+    "jpeg_quality": 80,
+    "lightcurve_figsize": None,
+    "observing_chart_figsize": None,
+    "combine": "none",
+}
+
+telegram_caption_limit = 1024 # characters
 
 def bot_status_update(msg, test_mode=False, loglevel="info"):
     """
@@ -64,7 +89,15 @@ class Listener:
         a dict with `username`, `bootstrap.server`, `group_id` - sign up to fink-client for this.
     listener_config [optional]
         a (nested) dict. see configs for a default. currently contains
-            {sleep_time: <>, consumer: {num_alerts: <IGNORED>, timeout: <>, topics: [<>, <>]}}
+            {sleep_time: <>, consumer: {num_alerts: <>, timeout: <>, topics: [<>, <>]},
+            workers: {use_processes: <>, max_tasks: <>, max_rss_mb: <>, max_retries: <>, task_timeout: <>},
+            media: {format: <png/jpg>, dpi: <>, jpeg_quality: <>, lightcurve_figsize: <>,
+                observing_chart_figsize: <>, combine: <none/media_group/composite>},
+            profiling: {enabled: <>, num_alerts: <>, interval: <>},
+            debounce: {hold_time: <>, max_delay: <>}}
+
+    profiling can also be switched on for the next `num_alerts` alerts with
+    `kill -USR1 <pid>`. output goes to alertDB/profiles.
     """
 
 
@@ -107,21 +140,64 @@ class Listener:
             EarthLocation.of_site("La Silla Observatory")
         ]
 
+        self.filter_lookup = default_filter_lookup
+        if _ztf_config_path.exists():
+            with open(_ztf_config_path, "r") as f:
+                ztf_config = yaml.load(f, Loader=yaml.FullLoader)
+            self.filter_lookup = ztf_config.get("filter_lookup", default_filter_lookup)
+
+        self.media_config = default_media_config.copy()
+        self.media_config.update(self.listener_config.get("media", {}))
+        if self.media_config["format"] not in ("png", "jpg"):
+            raise ValueError(
+                f"media format should be 'png' or 'jpg', not {self.media_config['format']}"
+            )
+        if self.media_config["combine"] not in ("none", "media_group", "composite"):
+            raise ValueError(
+                f"media combine should be 'none', 'media_group' or 'composite', "
+                f"not {self.media_config['combine']}"
+            )
+
+        # querying and plotting run in a worker process which is recycled regularly,
+        # so memory stays flat and a bad alert can't take down the listener.
+        self.workers_config = self.listener_config.get("workers", {})
+        self.workers = WorkerSupervisor(self.run_task, **self.workers_config)
+
+        self.profiling_config = self.listener_config.get("profiling", {})
+        self.profiler = AlertProfiler(
+            interval=self.profiling_config.get("interval", 0.005)
+        )
+        self.profile_remaining = 0
+        if self.profiling_config.get("enabled", False):
+            self.profile_remaining = self.profiling_config.get("num_alerts", 10)
+
+        # collapse repeated alerts for the same object into one update.
+        self.debounce_config = self.listener_config.get("debounce", {})
+        self.debouncer = AlertDebouncer(**self.debounce_config)
+
 
     def listen_for_alerts(self,):
         num_alerts = self.consumer_config.get("num_alerts", 1)
         timeout = self.consumer_config.get("timeout", 5)
-        logger.info(f"listening for {timeout} sec...")
+        logger.info(f"listening for {timeout} sec (up to {num_alerts} alerts)...")
+        latest_alerts = []
+        deadline = time.monotonic() + timeout
         with AlertConsumer(self.topics, self.credential_config) as consumer:
             # Context manager so no consumer.close()
 
             # consume not working for topics other than sso?? use poll for now...
             ## latest_alerts = consumer.consume(num_alerts=num_alerts, timeout=timeout)
-            topic, alert, key = consumer.poll(timeout=timeout)
-            if any([x is None for x in [topic, alert, key]]):
-                return []
-            else:
-                latest_alerts = [(topic, alert, key, )]
+            # so keep polling until we have a batch, or run out of time.
+            while len(latest_alerts) < num_alerts:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                topic, alert, key = consumer.poll(timeout=remaining)
+                if any([x is None for x in [topic, alert, key]]):
+                    break # poll timed out - nothing more this cycle.
+                latest_alerts.append((topic, alert, key, ))
+        if len(latest_alerts) > 0:
+            logger.info(f"received {len(latest_alerts)} alerts")
         return latest_alerts
 
 
@@ -132,95 +208,262 @@ class Listener:
         write_alert(alert, _parsed_schema, outdir, overwrite=True)
 
 
+    def alert_details(self, topic, alert, outdir=None):
+        """
+        enough to find (and replay) an alert dumped by dump_alert.
+        """
+        if outdir is None:
+            outdir = paths.alertDB_path
+        candid = alert["candidate"]["candid"]
+        return {
+            "topic": topic,
+            "objectId": alert["objectId"],
+            "candid": candid,
+            "alert_path": str(Path(outdir) / f"{alert['objectId']}_{candid}.avro"), # as named by write_alert
+        }
+
+
     def process_alerts(self, latest_alerts, **kwargs):
+        if self.profile_remaining <= 0:
+            self._process_alerts(latest_alerts, profile=False)
+            return
+
+        timestamp = datetime.datetime.now().strftime("%H%M%S")
+        with self.profiler.profile(f"{self.datestamp}_{timestamp}_process_alerts"):
+            self._process_alerts(latest_alerts, profile=True)
+        self.profile_remaining = max(self.profile_remaining - len(latest_alerts), 0)
+        if self.profile_remaining == 0:
+            self.profiler.stop()
+            logger.info("finished profiling")
+
+
+    def _process_alerts(self, latest_alerts, profile=False):
 
         logger.info(f"{len(latest_alerts)} new alerts!")
+        # so profiles of the same object later in the day don't overwrite these.
+        timestamp = datetime.datetime.now().strftime("%H%M%S")
+        prepared_alerts = []
         for topic, alert, key in latest_alerts:
-            self.dump_alert(topic, alert, key)
-            new_alert = alert["candidate"]
-
-            extra_keys = [
-                'candid', 'objectId', 'timestamp', 'cdsxmatch', 
-                'rf_snia_vs_nonia', 'snn_snia_vs_nonia', 'snn_sn_vs_all', 
-                'mulens', 'roid', 'nalerthist', 'rf_kn_vs_nonkn'
-            ]
-            new_alert.update({k: alert[k] for k in extra_keys} )
-
-            alert_history = pd.DataFrame(alert["prv_candidates"])
-            if len(alert_history) == 0:
+            try:
+                profile_label = f"{self.datestamp}_{timestamp}_{alert['objectId']}_prepare" if profile else None
+                new_alert, alert_history = self.workers.submit(
+                    ("prepare_alert", (alert,), {}, profile_label),
+                    label=alert["objectId"], details=self.alert_details(topic, alert)
+                )
+            except WorkerTaskError as e:
+                logger.error(e) # already dead-lettered by the supervisor.
                 continue
-            if any([x is None for x in alert_history["magpsf"]]):
-                prv_candidates = pd.DataFrame(alert["prv_candidates"])
-                logger.info("launch query")
-                alert_history = FinkQuery.query_objects(
-                    objectId=alert["objectId"], return_df=True
+            except Exception:
+                self.dead_letter_alert(topic, alert, "prepare")
+                continue
+            if alert_history is None:
+                continue
+            prepared_alerts.append((topic, alert, new_alert, alert_history))
+
+        if len(prepared_alerts) == 0:
+            return
+
+        try:
+            features = compute_lightcurve_features(
+                [alert_history for _, _, _, alert_history in prepared_alerts],
+                object_ids=[new_alert["objectId"] for _, _, new_alert, _ in prepared_alerts],
+                filter_lookup=self.filter_lookup,
+            )
+            features["score"] = kilonova_score(features)
+            ranking = rank_candidates(features)
+        except Exception:
+            # still send everything - just unranked, and without features.
+            tr = traceback.format_exc()
+            logger.error(f"lightcurve features failed, send alerts unranked:\n{tr}")
+            features = None
+            ranking = np.arange(len(prepared_alerts))
+
+        for rank, ii in enumerate(ranking):
+            topic, alert, new_alert, alert_history = prepared_alerts[ii]
+            if features is None:
+                render_kwargs = dict()
+            else:
+                render_kwargs = dict(obj_features=features.iloc[ii], rank=(rank+1, len(ranking)))
+            try:
+                profile_label = f"{self.datestamp}_{timestamp}_{new_alert['objectId']}_render" if profile else None
+                msg, fig_paths = self.workers.submit(
+                    ("render_alert", (topic, alert, new_alert, alert_history), render_kwargs, profile_label),
+                    label=new_alert["objectId"], details=self.alert_details(topic, alert)
                 )
-                column_lookup = {
-                    col: col.split(":")[1] if ":" in col else col for col in alert_history.columns
-                }
-                alert_history.rename(column_lookup, axis=1, inplace=True)
+                self.update_users(texts=msg, fig_paths=fig_paths)
+            except WorkerTaskError as e:
+                logger.error(e)
+                continue
+            except Exception:
+                self.dead_letter_alert(topic, alert, "render")
+                continue
 
-            alert_history.append(new_alert, ignore_index=True)
 
-            postage_stamps = {
-                imtype: readstamp(alert.get('cutout'+imtype, {}).get('stampData', None)) 
-                for imtype in FinkQuery.imtypes
-            }
+    def dead_letter_alert(self, topic, alert, stage):
+        """
+        Dead-letter an alert which failed in this (parent) process, rather than in a worker.
+        Call from an except block - the current traceback is saved.
+        """
+        tr = traceback.format_exc()
+        logger.error(f"{stage} failed in parent process:\n{tr}")
+        try:
+            details = self.alert_details(topic, alert)
+            label = details["objectId"]
+        except Exception:
+            # eg. alert with no objectId/candid - keep what we can.
+            details = {"topic": topic, "keys": sorted(alert.keys()) if isinstance(alert, dict) else None}
+            label = "unknown_alert"
+        failures = [{"attempt": 1, "status": f"{stage} error", "details": tr}]
+        try:
+            self.workers.dead_letter(f"{label}_{stage}", failures, details=details)
+        except Exception:
+            logger.error(f"could not dead-letter {label}:\n{traceback.format_exc()}")
 
-            fig, fig_path = self.plot_lightcurve(
-                alert_history, new_alert, postage_stamps=postage_stamps,
-                info1=dict(
-                    kn_prob=f"{new_alert['rf_kn_vs_nonkn']:.2f}", 
-                    sn_prob=f"{new_alert['snn_sn_vs_all']:.2f}"
-                )
+
+    def run_task(self, task):
+        """
+        Called by the worker process - task is (method_name, args, kwargs, profile_label).
+        """
+        method_name, args, kwargs, profile_label = task
+        if profile_label is None:
+            if self.profiler.active:
+                self.profiler.stop()
+            return getattr(self, method_name)(*args, **kwargs)
+        with self.profiler.profile(profile_label):
+            return getattr(self, method_name)(*args, **kwargs)
+
+
+    def start_profiling(self, signum=None, frame=None):
+        self.profile_remaining = self.profiling_config.get("num_alerts", 10)
+        logger.info(f"profile the next {self.profile_remaining} alerts")
+
+
+    def prepare_alert(self, alert):
+        new_alert = alert["candidate"]
+
+        extra_keys = [
+            'candid', 'objectId', 'timestamp', 'cdsxmatch', 
+            'rf_snia_vs_nonia', 'snn_snia_vs_nonia', 'snn_sn_vs_all', 
+            'mulens', 'roid', 'nalerthist', 'rf_kn_vs_nonkn'
+        ]
+        new_alert.update({k: alert[k] for k in extra_keys} )
+
+        alert_history = pd.DataFrame(alert["prv_candidates"])
+        # from earlier alerts held by the debouncer - kept out of prv_candidates, so that
+        # the decision to query the portal below is made on the alert as fink sent it.
+        merged_candidates = pd.DataFrame(alert.get("merged_candidates") or [])
+        if len(alert_history) == 0 and len(merged_candidates) == 0:
+            return new_alert, None
+        if len(alert_history) > 0 and any([x is None for x in alert_history["magpsf"]]):
+            logger.info("launch query")
+            alert_history = FinkQuery.query_objects(
+                objectId=alert["objectId"], return_df=True
+            )
+            column_lookup = {
+                col: col.split(":")[1] if ":" in col else col for col in alert_history.columns
+            }
+            alert_history.rename(column_lookup, axis=1, inplace=True)
+
+        if len(merged_candidates) > 0:
+            # the portal may not have these yet.
+            known_candids = alert_history["candid"].values if "candid" in alert_history else []
+            missing = merged_candidates[~merged_candidates["candid"].isin(known_candids)]
+            if len(missing) > 0:
+                alert_history = pd.concat([alert_history, missing], ignore_index=True)
+
+        known_candids = alert_history["candid"].values if "candid" in alert_history else []
+        if new_alert["candid"] not in known_candids:
+            alert_history = pd.concat(
+                [alert_history, pd.DataFrame([new_alert])], ignore_index=True
             )
-            plt.close(fig)
-
-            observing_charts = []
-            for observatory in self.observatories:
-                oc_fig, oc_fig_path = self.plot_observing_chart(new_alert, observatory)
-                plt.close(oc_fig)
-                observing_charts.append(oc_fig_path)
-
-            alert_timestamp = Time(new_alert['jd'], format="jd").to_value("iso")
-            msg = (
-                f"New {topic} alert!\n"
-                f"at {alert_timestamp} {new_alert['objectId']}\n\n"
-                f"ra={new_alert['ra']:.5f}, dec={new_alert['dec']:.4f}\n"
-                f"magnitude {new_alert['magpsf']:.2f}\n"
-                f"{len(alert_history)} alerts total "
-                f"({sum(~np.isfinite(alert_history['magpsf']))} bad/limits)\n\n"
-                f"fink-portal.org/{new_alert['objectId']}"
+        return new_alert, alert_history
+
+
+    def render_alert(
+        self, topic, alert, new_alert, alert_history, obj_features=None, rank=None
+    ):
+        postage_stamps = {
+            imtype: readstamp(alert.get('cutout'+imtype, {}).get('stampData', None)) 
+            for imtype in FinkQuery.imtypes
+        }
+
+        fig, fig_path = self.plot_lightcurve(
+            alert_history, new_alert, postage_stamps=postage_stamps,
+            info1=dict(
+                kn_prob=f"{new_alert['rf_kn_vs_nonkn']:.2f}", 
+                sn_prob=f"{new_alert['snn_sn_vs_all']:.2f}"
             )
+        )
+        plt.close(fig)
 
-            self.update_users(
-                texts=msg, fig_paths=[fig_path] + observing_charts
+        target = SkyCoord(ra=new_alert["ra"], dec=new_alert["dec"], unit="deg")
+        observing_charts = []
+        observing_windows = []
+        for observatory in self.observatories:
+            night_table = get_night_table(observatory)
+            oc_fig, oc_fig_path = self.plot_observing_chart(
+                new_alert, observatory, night_table=night_table
             )
+            plt.close(oc_fig)
+            observing_charts.append(oc_fig_path)
+            windows = target_observable_windows(target, observatory, night_table)
+            observing_windows.append(format_windows(windows, night_table))
+
+        alert_timestamp = Time(new_alert['jd'], format="jd").to_value("iso")
+        msg = (
+            f"New {topic} alert!\n"
+            f"at {alert_timestamp} {new_alert['objectId']}\n\n"
+            f"ra={new_alert['ra']:.5f}, dec={new_alert['dec']:.4f}\n"
+            f"magnitude {new_alert['magpsf']:.2f}\n"
+            f"{len(alert_history)} alerts total "
+            f"({sum(~np.isfinite(alert_history['magpsf']))} bad/limits)\n\n"
+        )
+        if len(observing_windows) > 0:
+            msg = msg + "\n".join(observing_windows) + "\n\n"
+        if obj_features is not None:
+            feature_text = format_features(obj_features, filter_lookup=self.filter_lookup)
+            if len(feature_text) > 0:
+                msg = msg + feature_text + "\n"
+        if rank is not None and rank[1] > 1:
+            msg = msg + f"candidate {rank[0]} of {rank[1]} this cycle\n"
+        msg = msg + f"\nfink-portal.org/{new_alert['objectId']}"
+
+        fig_paths = [fig_path] + observing_charts
+        if self.media_config["combine"] == "composite":
+            fig_paths = [self.combine_figures(new_alert, fig_paths)]
+        return msg, fig_paths
 
 
     def plot_lightcurve(self, lc_data, new_alert, postage_stamps, **kwargs):
         logger.info("plotting lightcurve")
-        fig = plot_lightcurve(lc_data, new_alert, postage_stamps=postage_stamps, **kwargs)
+        fig = plot_lightcurve(
+            lc_data, new_alert, postage_stamps=postage_stamps,
+            figsize=self.media_config["lightcurve_figsize"], **kwargs
+        )
         fig_dir = paths.alertDB_path / f"lc_plots/{self.datestamp}"
         fig_dir.mkdir(exist_ok=True, parents=True)
-        fig_path = fig_dir / f"{new_alert['objectId']}.png"
+        ext = self.media_config["format"]
+        fig_path = fig_dir / f"{new_alert['objectId']}.{ext}"
         ii = 0
         while fig_path.exists():
-            fig_path = fig_dir / f"{new_alert['objectId']}_{ii}.png"
+            fig_path = fig_dir / f"{new_alert['objectId']}_{ii}.{ext}"
             ii = ii + 1
         try:
             print_path = fig_path.relative_to(paths.base_path)
         except:
             print_path = fig_path
         logger.info(f"save lc to {print_path}")
-        fig.savefig(fig_path)
+        self.save_figure(fig, fig_path)
         return fig, fig_path
 
 
-    def plot_observing_chart(self, new_alert, observatory: EarthLocation):
+    def plot_observing_chart(self, new_alert, observatory: EarthLocation, night_table=None):
         logger.info("plot observing charts")
         target = SkyCoord(ra=new_alert["ra"], dec=new_alert["dec"], unit="deg")
-        fig = plot_observing_chart(target, observatory)
+        fig = plot_observing_chart(
+            target, observatory, figsize=self.media_config["observing_chart_figsize"],
+            night_table=night_table
+        )
         fig_dir = paths.alertDB_path / f"oc_plots/{self.datestamp}"
         fig_dir.mkdir(exist_ok=True, parents=True)
 
@@ -236,21 +479,52 @@ class Listener:
             suffix = f"{lon_str}{lon_card}_{lat_str}{lat_card}"
 
         suffix = suffix.replace(" ", "_")
-        fig_path = fig_dir / f"{new_alert['objectId']}_{suffix}.png"
+        ext = self.media_config["format"]
+        fig_path = fig_dir / f"{new_alert['objectId']}_{suffix}.{ext}"
         ii = 0
         while fig_path.exists():
-            fig_path = fig_path = fig_dir / f"{new_alert['objectId']}_{suffix}_{ii}.png"
+            fig_path = fig_path = fig_dir / f"{new_alert['objectId']}_{suffix}_{ii}.{ext}"
             ii = ii + 1
         try:
             print_path = fig_path.relative_to(paths.base_path)
         except:
             print_path = fig_path
-        fig.savefig(fig_path)
+        self.save_figure(fig, fig_path)
         logger.info(f"save lc to {print_path}")
         return fig, fig_path
 
 
-    def send_to_user(self, chat_id, texts=None, fig_paths=None):
+    def save_figure(self, fig, fig_path):
+        save_kwargs = dict(dpi=self.media_config["dpi"])
+        if self.media_config["format"] == "jpg":
+            save_kwargs["pil_kwargs"] = {"quality": self.media_config["jpeg_quality"]}
+        fig.savefig(fig_path, **save_kwargs)
+
+
+    def combine_figures(self, new_alert, fig_paths):
+        fig_dir = paths.alertDB_path / f"composite_plots/{self.datestamp}"
+        fig_dir.mkdir(exist_ok=True, parents=True)
+        ext = self.media_config["format"]
+        fig_path = fig_dir / f"{new_alert['objectId']}.{ext}"
+        ii = 0
+        while fig_path.exists():
+            fig_path = fig_dir / f"{new_alert['objectId']}_{ii}.{ext}"
+            ii = ii + 1
+        save_kwargs = {}
+        if ext == "jpg":
+            save_kwargs["quality"] = self.media_config["jpeg_quality"]
+        logger.info("combine figures")
+        return combine_images(fig_paths, fig_path, **save_kwargs)
+
+
+    def send_to_user(self, chat_id, texts=None, fig_paths=None, uploaded=None):
+        """
+        parameters
+        ----------
+        uploaded [optional]
+            dict of {fig_path: telegram file_id}. figures already in here are sent by
+            file_id rather than uploaded again - and newly uploaded figures are added to it.
+        """
         if texts is None:
             texts = []
         if isinstance(texts, str):
@@ -258,14 +532,48 @@ class Listener:
         if fig_paths is None:
             fig_paths = []
         if isinstance(fig_paths, (str, Path)):
-            figs = [fig_paths]
+            fig_paths = [fig_paths]
+        if uploaded is None:
+            uploaded = {}
+
+        if self.media_config["combine"] == "none" or len(fig_paths) == 0:
+            for text in texts:
+                self.bot.send_message(chat_id=chat_id, text=text)
+            for fig_path in fig_paths:
+                with open(fig_path, "rb") as fig:
+                    message = self.bot.send_photo(
+                        chat_id=chat_id, photo=uploaded.get(fig_path, fig)
+                    )
+                uploaded[fig_path] = message.photo[-1].file_id
+            return
+
+        # attach the text as a caption if it fits, else send it first as usual.
+        caption = None
+        if len(texts) == 1 and len(texts[0]) <= telegram_caption_limit:
+            caption = texts[0]
+        else:
+            for text in texts:
+                self.bot.send_message(chat_id=chat_id, text=text)
+
+        files = {p: open(p, "rb") for p in fig_paths if p not in uploaded}
+        try:
+            photos = [uploaded[p] if p in uploaded else files[p] for p in fig_paths]
+            if len(photos) == 1:
+                messages = [
+                    self.bot.send_photo(chat_id=chat_id, photo=photos[0], caption=caption)
+                ]
+            else:
+                media = [
+                    InputMediaPhoto(media=photo, caption=caption if ii == 0 else None)
+                    for ii, photo in enumerate(photos)
+                ]
+                messages = self.bot.send_media_group(chat_id=chat_id, media=media)
+        finally:
+            for f in files.values():
+                f.close()
+        for fig_path, message in zip(fig_paths, messages):
+            uploaded[fig_path] = message.photo[-1].file_id
 
-        for text in texts:
-            self.bot.send_message(chat_id=chat_id, text=text)
-        for fig_path in fig_paths:
-            with open(fig_path, "rb") as fig:
-                self.bot.send_photo(chat_id=chat_id, photo=fig)
-        
 
     def update_users(self, texts=None, fig_paths=None):
         telegram_users_path = paths.config_path / "telegram_users.yaml"
@@ -275,10 +583,11 @@ class Listener:
             telegram_users = self.test_users
         
 
+        uploaded = {} # upload each figure once, then re-use its file_id for other users.
         for user in telegram_users:
             user_errors = []
             try:
-                self.send_to_user(user, texts=texts, fig_paths=fig_paths)
+                self.send_to_user(user, texts=texts, fig_paths=fig_paths, uploaded=uploaded)
             except Exception as e:
                 tr = traceback.format_exc()
                 print(tr)
@@ -329,13 +638,34 @@ class Listener:
 
 
     def start(self):
-        while True:
-            logger.info(f"sleep for {self.sleep_time} sec...")
-            time.sleep(self.sleep_time)
-            self.datestamp = datetime.datetime.now().strftime("%Y%m%d")
-            latest_alerts = self.listen_for_alerts()
-            if len(latest_alerts) == 0:
-                continue
-            self.process_alerts(latest_alerts)
-            #updates = self.listen_for_user_updates()
-            #self.respond_to_user_updates(updates)
+        signal.signal(signal.SIGUSR1, self.start_profiling)
+        try:
+            while True:
+                logger.info(f"sleep for {self.sleep_time} sec...")
+                time.sleep(self.sleep_time)
+                datestamp = datetime.datetime.now().strftime("%Y%m%d")
+                if datestamp != self.datestamp:
+                    self.datestamp = datestamp
+                    # the worker is forked with a copy of self - make sure it sees the new date.
+                    self.workers.recycle(reason="new day")
+                latest_alerts = self.listen_for_alerts()
+                for topic, alert, key in latest_alerts:
+                    # one bad alert shouldn't stop the others being held/processed.
+                    try:
+                        self.dump_alert(topic, alert, key)
+                        self.debouncer.add([(topic, alert, key)])
+                    except Exception:
+                        self.dead_letter_alert(topic, alert, "receive")
+                ready_alerts = self.debouncer.pop_ready()
+                if len(ready_alerts) == 0:
+                    continue
+                self.process_alerts(ready_alerts)
+                #updates = self.listen_for_user_updates()
+                #self.respond_to_user_updates(updates)
+        finally:
+            if len(self.debouncer.pending) > 0:
+                logger.warning(
+                    f"stopping with {len(self.debouncer.pending)} objects still held: "
+                    + ", ".join(self.debouncer.pending.keys())
+                )
+            self.workers.stop()
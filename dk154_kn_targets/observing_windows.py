@@ -0,0 +1,289 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+from astropy.coordinates import AltAz, EarthLocation, SkyCoord
+from astropy.coordinates import get_body, get_sun
+from astropy.time import Time
+
+from dk154_kn_targets import paths
+
+logger = logging.getLogger(__name__)
+
+observing_windows_path = paths.alertDB_path / "observing_windows"
+
+twilight_altitudes = {
+    "sunset": 0., "civil": -6., "nautical": -12., "astronomical": -18.
+} # deg
+
+_night_tables = {}
+
+
+def observatory_name(observatory: EarthLocation):
+    try:
+        name = observatory.info.name
+    except Exception:
+        name = None
+    # info.name is None (rather than missing) for eg. EarthLocation.from_geodetic
+    if name is None:
+        lat = observatory.lat.signed_dms
+        lon = observatory.lon.signed_dms
+        lat_card = "S" if lat.sign < 0 else "N"
+        lon_card = "W" if lon.sign < 0 else "E"
+        return (
+            f"{round(lat.d)}{round(lat.m)}{round(lat.s)}{lat_card}_"
+            f"{round(lon.d)}{round(lon.m)}{round(lon.s)}{lon_card}"
+        )
+    return name
+
+
+def local_noon_before(observatory: EarthLocation, t_ref: Time):
+    """
+    Time of (mean solar) local noon preceding t_ref. A "night" runs noon-to-noon.
+    """
+    lon_day = observatory.lon.deg / 360.
+    noon_mjd = np.floor(t_ref.mjd + lon_day - 0.5) + 0.5 - lon_day
+    return Time(noon_mjd, format="mjd")
+
+
+def _sun_alt(observatory):
+    def alt_func(mjd):
+        t = Time(mjd, format="mjd")
+        return get_sun(t).transform_to(AltAz(obstime=t, location=observatory)).alt.deg
+    return alt_func
+
+
+def _moon_alt(observatory):
+    def alt_func(mjd):
+        t = Time(mjd, format="mjd")
+        moon = get_body("moon", t, location=observatory)
+        return moon.transform_to(AltAz(obstime=t, location=observatory)).alt.deg
+    return alt_func
+
+
+def _target_alt(target, observatory):
+    def alt_func(mjd):
+        t = Time(mjd, format="mjd")
+        return target.transform_to(AltAz(obstime=t, location=observatory)).alt.deg
+    return alt_func
+
+
+def find_crossings(alt_func, mjd_start, mjd_end, thresholds, n_coarse=49, n_iter=12):
+    """
+    Find when alt_func(mjd) crosses each of thresholds between mjd_start and mjd_end.
+
+    alt_func is evaluated once on a coarse grid (default 30 min for 24 hr) to bracket
+    the crossings, then all of the brackets are bisected together - so each iteration
+    is one vectorised coordinate transform. 12 iterations of 30 min is ~0.5 sec.
+
+    returns
+    -------
+    crossings
+        list of (mjd, threshold, rising), sorted by mjd.
+    grid_mjd, grid_alt
+        the coarse grid, useful to tell if the start is above/below a threshold.
+    """
+    grid_mjd = np.linspace(mjd_start, mjd_end, n_coarse)
+    grid_alt = alt_func(grid_mjd)
+
+    lo, hi, bracket_thresh = [], [], []
+    for threshold in thresholds:
+        above = grid_alt > threshold
+        idx = np.flatnonzero(above[1:] != above[:-1])
+        lo.append(grid_mjd[idx])
+        hi.append(grid_mjd[idx + 1])
+        bracket_thresh.append(np.full(len(idx), threshold))
+    lo, hi = np.concatenate(lo), np.concatenate(hi)
+    bracket_thresh = np.concatenate(bracket_thresh)
+    if len(lo) == 0:
+        return [], grid_mjd, grid_alt
+
+    lo_above = alt_func(lo) > bracket_thresh
+    for ii in range(n_iter):
+        mid = 0.5 * (lo + hi)
+        mid_above = alt_func(mid) > bracket_thresh
+        same_as_lo = mid_above == lo_above
+        lo = np.where(same_as_lo, mid, lo)
+        hi = np.where(same_as_lo, hi, mid)
+    crossing_mjd = 0.5 * (lo + hi)
+    rising = ~lo_above
+
+    order = np.argsort(crossing_mjd)
+    crossings = [
+        (crossing_mjd[ii], bracket_thresh[ii], rising[ii]) for ii in order
+    ]
+    return crossings, grid_mjd, grid_alt
+
+
+def above_intervals(alt_func, mjd_start, mjd_end, threshold, n_coarse=25):
+    """
+    list of (mjd_start, mjd_end) where alt_func(mjd) > threshold.
+    """
+    crossings, grid_mjd, grid_alt = find_crossings(
+        alt_func, mjd_start, mjd_end, [threshold], n_coarse=n_coarse
+    )
+    intervals = []
+    interval_start = mjd_start if grid_alt[0] > threshold else None
+    for mjd, _, rising in crossings:
+        if rising:
+            interval_start = mjd
+        elif interval_start is not None:
+            intervals.append((interval_start, mjd))
+            interval_start = None
+    if interval_start is not None:
+        intervals.append((interval_start, mjd_end))
+    return intervals
+
+
+def moon_illumination(t: Time):
+    """
+    illuminated fraction of the moon, from the sun-moon elongation.
+    """
+    sun = get_sun(t)
+    moon = get_body("moon", t)
+    elongation = sun.separation(moon)
+    phase_angle = np.arctan2(
+        sun.distance * np.sin(elongation),
+        moon.distance - sun.distance * np.cos(elongation)
+    )
+    return (1. + np.cos(phase_angle)) / 2.
+
+
+def compute_night_table(observatory: EarthLocation, night_start: Time, n_chart=24*12):
+    """
+    Sun/twilight and moon events for the (noon-to-noon) night starting at night_start.
+    All times are mjd, or None if it doesn't happen (eg. the moon doesn't rise).
+
+    Also includes the moon altitude on the `chart_mjd` grid used by observing charts,
+    as it's the same for every target.
+    """
+    mjd_start = night_start.mjd
+    mjd_end = mjd_start + 1.
+
+    table = {
+        "observatory": observatory_name(observatory),
+        "night": night_start.strftime("%Y%m%d"),
+        "night_start": mjd_start,
+        "night_end": mjd_end,
+    }
+
+    sun_crossings, _, _ = find_crossings(
+        _sun_alt(observatory), mjd_start, mjd_end, list(twilight_altitudes.values())
+    )
+    for name, altitude in twilight_altitudes.items():
+        set_key, rise_key = ("sunset", "sunrise") if name == "sunset" else (f"{name}_dusk", f"{name}_dawn")
+        table[set_key] = None
+        table[rise_key] = None
+        for mjd, threshold, rising in sun_crossings:
+            if threshold != altitude:
+                continue
+            if rising and table[rise_key] is None:
+                table[rise_key] = float(mjd)
+            elif not rising and table[set_key] is None:
+                table[set_key] = float(mjd)
+
+    moon_crossings, _, _ = find_crossings(
+        _moon_alt(observatory), mjd_start, mjd_end, [0.]
+    )
+    table["moonrise"] = next((float(t) for t, _, r in moon_crossings if r), None)
+    table["moonset"] = next((float(t) for t, _, r in moon_crossings if not r), None)
+
+    midnight = 0.5 * (mjd_start + mjd_end)
+    table["moon_illumination"] = float(moon_illumination(Time(midnight, format="mjd")))
+
+    chart_mjd = np.linspace(mjd_start, mjd_end, n_chart)
+    table["chart_mjd"] = chart_mjd.tolist()
+    table["moon_alt"] = _moon_alt(observatory)(chart_mjd).tolist()
+    return table
+
+
+def _load_night_table(observatory: EarthLocation, night_start: Time):
+    name = observatory_name(observatory).replace(" ", "_")
+    night = night_start.strftime("%Y%m%d")
+
+    key = (name, night)
+    if key in _night_tables:
+        return _night_tables[key]
+
+    table = None
+    table_path = observing_windows_path / f"{night}_{name}.json"
+    if table_path.exists():
+        try:
+            with open(table_path, "r") as f:
+                table = json.load(f)
+        except json.JSONDecodeError as e:
+            logger.warning(f"bad night table {table_path.name} ({e}), recompute")
+    if table is None:
+        logger.info(f"compute night table for {name} {night}")
+        table = compute_night_table(observatory, night_start)
+        observing_windows_path.mkdir(exist_ok=True, parents=True)
+        # write then rename, so a worker killed mid-write can't leave a truncated table.
+        tmp_path = table_path.with_name(f"{table_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(table, f)
+        os.replace(tmp_path, table_path)
+    _night_tables[key] = table
+    return table
+
+
+def get_night_table(observatory: EarthLocation, t_ref: Time = None):
+    """
+    Night table for "tonight" as seen at t_ref (default now) - the noon-to-noon night
+    containing t_ref, or the following night once the sun has risen.
+    Computed once per night per observatory, kept in memory and in
+    alertDB/observing_windows so that new worker processes don't recompute it.
+    """
+    if t_ref is None:
+        t_ref = Time.now()
+    night_start = local_noon_before(observatory, t_ref)
+    table = _load_night_table(observatory, night_start)
+    if table["sunrise"] is not None and t_ref.mjd > table["sunrise"]:
+        next_night_start = Time(night_start.mjd + 1., format="mjd")
+        table = _load_night_table(observatory, next_night_start)
+    return table
+
+
+def dark_time(night_table):
+    """
+    (start, end) mjd of the darkest part of the night available - astronomical
+    twilight if there is one, else nautical, civil, or sunset.
+    """
+    for name in ["astronomical", "nautical", "civil"]:
+        start, end = night_table[f"{name}_dusk"], night_table[f"{name}_dawn"]
+        if start is not None and end is not None:
+            return start, end
+    return night_table["sunset"], night_table["sunrise"]
+
+
+def target_observable_windows(
+    target: SkyCoord, observatory: EarthLocation, night_table, min_alt=30., t_now=None
+):
+    """
+    list of (start, end) mjd where target is above min_alt (deg) during the rest
+    of the dark time - ie. after t_now (default now).
+    """
+    if t_now is None:
+        t_now = Time.now()
+    start, end = dark_time(night_table)
+    if start is None or end is None:
+        return []
+    start = max(start, t_now.mjd)
+    if start >= end:
+        return []
+    return above_intervals(_target_alt(target, observatory), start, end, min_alt)
+
+
+def format_windows(windows, night_table, min_alt=30.):
+    if len(windows) == 0:
+        return f"not above {min_alt:.0f} deg in dark time from {night_table['observatory']}"
+    window_strs = [
+        f"{Time(start, format='mjd').strftime('%H:%M')}-{Time(end, format='mjd').strftime('%H:%M')}"
+        for start, end in windows
+    ]
+    return (
+        "observable tonight " + ", ".join(window_strs) + " UT "
+        f"from {night_table['observatory']} "
+        f"(moon {100 * night_table['moon_illumination']:.0f}%)"
+    )
@@ -20,11 +20,11 @@ lc_gs = plt.GridSpec(3,4)
 zscaler = ZScaleInterval()
 
 def plot_lightcurve(
-    obj_df, new_alert, postage_stamps=None,  **kwargs
+    obj_df, new_alert, postage_stamps=None, figsize=None, **kwargs
 ):
     obj_df.sort_values("jd", inplace=True, ascending=False)
 
-    fig = plt.figure()
+    fig = plt.figure(figsize=figsize)
 
     filter_lookup =  {1:"g", 2: "r", 3: "i"}
 
@@ -139,37 +139,62 @@ def readstamp(stamp: str, return_type='array') -> np.array:
     return data
 
 
-def plot_observing_chart(target: SkyCoord, observatory: EarthLocation, t0=None):
-    if t0 is None:
-        t0 = Time.now()
-    time_grid = t0 + np.linspace(0, 24, 24*12) * u.hour
+def plot_observing_chart(
+    target: SkyCoord, observatory: EarthLocation, t0=None, figsize=None, night_table=None
+):
+    """
+    night_table [optional]
+        from observing_windows.get_night_table. if given, plot the local (noon-to-noon)
+        night, with twilight and the moon taken from the table instead of recomputed.
+    """
+    if night_table is not None:
+        t0 = Time(night_table["night_start"], format="mjd")
+        timestamps = np.array(night_table["chart_mjd"])
+        time_grid = Time(timestamps, format="mjd")
+    else:
+        if t0 is None:
+            t0 = Time.now()
+        time_grid = t0 + np.linspace(0, 24, 24*12) * u.hour
+        timestamps = time_grid.mjd
     #target = SkyCoord(ra=ra*u.deg, dec=dec*u.deg)
 
     altaz_transform = AltAz(obstime=time_grid, location=observatory)
     target_altaz = target.transform_to(altaz_transform)
 
-    moon_pos = get_moon(time_grid)
-    moon_altaz = moon_pos.transform_to(altaz_transform)
-    moon_dist = target.separation(SkyCoord(ra=moon_pos.ra, dec=moon_pos.dec))
-
-    sun_pos = get_sun(time_grid)
-    sun_altaz = sun_pos.transform_to(altaz_transform)
-    sun_dist = target.separation(SkyCoord(ra=sun_pos.ra, dec=sun_pos.dec))
-
-    fig, ax = plt.subplots()
+    fig, ax = plt.subplots(figsize=figsize)
+
+    if night_table is not None:
+        moon_alt = np.array(night_table["moon_alt"])
+        twilight_shading = [
+            ("sunset", "sunrise", "0.7"),
+            ("civil_dusk", "civil_dawn", "0.55"),
+            ("nautical_dusk", "nautical_dawn", "0.4"),
+            ("astronomical_dusk", "astronomical_dawn", "0.2"),
+        ]
+        for dusk_key, dawn_key, color in twilight_shading:
+            dusk = night_table[dusk_key] or timestamps[0]
+            dawn = night_table[dawn_key] or timestamps[-1]
+            if night_table[dusk_key] is None and night_table[dawn_key] is None:
+                continue
+            ax.axvspan(dusk, dawn, color=color)
+    else:
+        moon_pos = get_moon(time_grid)
+        moon_alt = moon_pos.transform_to(altaz_transform).alt.deg
 
-    timestamps = np.array([x.mjd for x in time_grid])
+        sun_pos = get_sun(time_grid)
+        sun_altaz = sun_pos.transform_to(altaz_transform)
 
-    ax.fill_between(
-        timestamps, -90*u.deg, 90*u.deg, sun_altaz.alt < 0*u.deg, color="0.7", 
-    )
-    ax.fill_between(
-        timestamps, -90*u.deg, 90*u.deg, sun_altaz.alt < -18*u.deg, color="0.2", 
-    )
+        ax.fill_between(
+            timestamps, -90*u.deg, 90*u.deg, sun_altaz.alt < 0*u.deg, color="0.7", 
+        )
+        ax.fill_between(
+            timestamps, -90*u.deg, 90*u.deg, sun_altaz.alt < -18*u.deg, color="0.2", 
+        )
 
     ax.plot(timestamps, target_altaz.alt.deg, color="b", label="target")
-    ax.plot(timestamps, moon_altaz.alt.deg, color="0.4", ls="--", label="moon")
-    ax.plot(timestamps, sun_altaz.alt.deg, color="0.4", ls=":", label="sun")
+    ax.plot(timestamps, moon_alt, color="0.4", ls="--", label="moon")
+    if night_table is None:
+        ax.plot(timestamps, sun_altaz.alt.deg, color="0.4", ls=":", label="sun")
     ax.set_ylim(0, 90)
     ax.set_ylabel("Altitude [deg]", fontsize=16)
 
@@ -222,5 +247,27 @@ def plot_observing_chart(target: SkyCoord, observatory: EarthLocation, t0=None):
 
 
     ax.legend()
+    fig.tight_layout() # keep the title and airmass label inside small (phone-sized) figures.
+
+    return fig
+
 
-    return fig
\ No newline at end of file
+def combine_images(image_paths, output_path, **save_kwargs):
+    """
+    Stack images vertically into one file (narrower images are centred on white).
+    save_kwargs are passed to PIL.Image.save, eg. quality=80 for jpg.
+    """
+    from PIL import Image # matplotlib already depends on pillow.
+
+    images = [Image.open(image_path).convert("RGB") for image_path in image_paths]
+    width = max(im.width for im in images)
+    height = sum(im.height for im in images)
+    composite = Image.new("RGB", (width, height), color="white")
+    y0 = 0
+    for im in images:
+        composite.paste(im, ((width - im.width) // 2, y0))
+        y0 = y0 + im.height
+    composite.save(output_path, **save_kwargs)
+    for im in images:
+        im.close()
+    return output_path
@@ -0,0 +1,154 @@
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+from dk154_kn_targets import paths
+
+logger = logging.getLogger(__name__)
+
+
+class StackSampler:
+    """
+    Sample the call stack of one thread every `interval` seconds, from a background thread.
+    Stacks are counted in "folded" form ("outer;inner;innermost count" per line) which
+    flamegraph.pl, speedscope, etc. read directly.
+
+    >>> sampler = StackSampler()
+    >>> sampler.start()
+    >>> do_slow_thing()
+    >>> sampler.stop()
+    >>> sampler.write_folded("slow_thing.folded")
+    """
+
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.counts = Counter()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+    def _sample(self):
+        while not self._stop_event.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            if len(stack) > 0:
+                self.counts[";".join(stack[::-1])] += 1
+            time.sleep(self.interval)
+
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+    def write_folded(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.counts.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class AlertProfiler:
+    """
+    Sample-profile and tracemalloc blocks of code (one alert/stage at a time),
+    writing to `output_dir`:
+        <label>.folded - sampled stacks, for a flamegraph.
+        <label>_alloc.txt - top allocation changes over the block, and since
+            profiling started (ie. what is growing from alert to alert).
+
+    >>> profiler = AlertProfiler()
+    >>> with profiler.profile("ZTF23abcdefg_render_alert"):
+    ...     render(alert)
+    >>> profiler.stop()
+    """
+
+    def __init__(self, output_dir=None, interval=0.005, n_top=25, n_frames=10):
+        if output_dir is None:
+            output_dir = paths.alertDB_path / "profiles"
+        self.output_dir = Path(output_dir)
+        self.interval = interval
+        self.n_top = n_top
+        self.n_frames = n_frames
+        self.baseline = None
+
+
+    @property
+    def active(self):
+        return self.baseline is not None
+
+
+    @contextmanager
+    def profile(self, label):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.n_frames)
+        if self.baseline is None:
+            self.baseline = tracemalloc.take_snapshot()
+        before = tracemalloc.take_snapshot()
+        sampler = StackSampler(interval=self.interval)
+        t0 = time.perf_counter()
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            duration = time.perf_counter() - t0
+            after = tracemalloc.take_snapshot()
+            self.write_results(label, sampler, before, after, duration)
+
+
+    def _filter(self, snapshot):
+        return snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ])
+
+
+    def write_results(self, label, sampler, before, after, duration):
+        self.output_dir.mkdir(exist_ok=True, parents=True)
+        folded_path = self.output_dir / f"{label}.folded"
+        sampler.write_folded(folded_path)
+
+        after = self._filter(after)
+        block_diff = after.compare_to(self._filter(before), "lineno")
+        growth_diff = after.compare_to(self._filter(self.baseline), "lineno")
+        current, peak = tracemalloc.get_traced_memory()
+
+        alloc_path = self.output_dir / f"{label}_alloc.txt"
+        with open(alloc_path, "w") as f:
+            f.write(f"{label}: {duration:.2f} sec, {sum(sampler.counts.values())} samples\n")
+            f.write(f"traced memory: current {current/1024**2:.1f} MB, peak {peak/1024**2:.1f} MB\n")
+            f.write(f"\ntop {self.n_top} allocation changes during {label}:\n")
+            for stat in block_diff[:self.n_top]:
+                f.write(f"{stat}\n")
+            f.write(f"\ntop {self.n_top} allocation changes since profiling started:\n")
+            for stat in growth_diff[:self.n_top]:
+                f.write(f"{stat}\n")
+        logger.info(f"{label} profiled in {duration:.2f} sec, written to {folded_path.parent}")
+
+
+    def stop(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.baseline = None
@@ -0,0 +1,203 @@
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import traceback
+from pathlib import Path
+
+from dk154_kn_targets import paths
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerTaskError(Exception):
+    pass
+
+
+def current_rss_mb():
+    """
+    resident memory of this process in MB. falls back to peak RSS if /proc is unavailable.
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            rss_pages = int(f.read().split()[1])
+        return rss_pages * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _worker_loop(handler, conn, parent_conn=None):
+    if parent_conn is not None:
+        # the forked child inherits the parent's end of the pipe - close it, else the
+        # pipe never sees EOF if the parent is killed, and the worker is orphaned.
+        parent_conn.close()
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if task is None:
+            break
+        try:
+            result = handler(task)
+            status = "ok"
+        except Exception:
+            result = traceback.format_exc()
+            status = "error"
+        try:
+            conn.send((status, result, current_rss_mb()))
+        except Exception:
+            # eg. result not picklable.
+            conn.send(("error", traceback.format_exc(), current_rss_mb()))
+    conn.close()
+
+
+class WorkerSupervisor:
+    """
+    Run tasks one at a time in a child process, which is replaced
+    after `max_tasks` tasks, or once its memory goes above `max_rss_mb`.
+    So whatever matplotlib/astropy/pandas leave lying around is thrown away regularly.
+
+    A task which raises, crashes the worker or runs over `task_timeout` gets a fresh
+    worker and is retried `max_retries` times, then is written to `alertDB/dead_letter`
+    and WorkerTaskError is raised for the caller to skip it.
+
+    >>> workers = WorkerSupervisor(handler, max_tasks=50)
+    >>> result = workers.submit(task, label="ZTF23abcdefg", details={"candid": 1234})
+
+    parameters
+    ----------
+    handler
+        callable, `handler(task)` is run in the worker. the worker is forked,
+        so handler can be a bound method (and need not be picklable) - but task and
+        the returned result are sent through a pipe so must be picklable.
+    use_processes [optional]
+        if False, run handler in this process (with the same retry/dead-letter behaviour).
+    """
+
+    def __init__(
+        self, handler, use_processes=True, max_tasks=50, max_rss_mb=1500.,
+        max_retries=1, task_timeout=300., dead_letter_path=None
+    ):
+        self.handler = handler
+        self.use_processes = use_processes
+        self.max_tasks = max_tasks
+        self.max_rss_mb = max_rss_mb
+        self.max_retries = max_retries
+        self.task_timeout = task_timeout
+        if dead_letter_path is None:
+            dead_letter_path = paths.alertDB_path / "dead_letter"
+        self.dead_letter_path = Path(dead_letter_path)
+
+        self._context = multiprocessing.get_context("fork")
+        self.process = None
+        self.conn = None
+        self.tasks_done = 0
+        self.last_rss_mb = 0.
+
+
+    def start_worker(self):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_loop, args=(self.handler, child_conn, parent_conn), daemon=True
+        )
+        process.start()
+        child_conn.close()
+        self.process = process
+        self.conn = parent_conn
+        self.tasks_done = 0
+        logger.info(f"started worker pid={process.pid}")
+
+
+    def recycle(self, reason=None, force=False):
+        if self.process is None:
+            return
+        if reason is not None:
+            logger.info(f"recycle worker pid={self.process.pid}: {reason}")
+        if self.process.is_alive() and not force:
+            try:
+                self.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout=5)
+        self.conn.close()
+        self.process = None
+        self.conn = None
+
+
+    def stop(self):
+        self.recycle(reason="stop")
+
+
+    def _run_once(self, task):
+        if not self.use_processes:
+            try:
+                return "ok", self.handler(task)
+            except Exception:
+                return "error", traceback.format_exc()
+
+        if self.process is None or not self.process.is_alive():
+            self.recycle()
+            self.start_worker()
+
+        try:
+            self.conn.send(task)
+            if not self.conn.poll(self.task_timeout):
+                self.recycle(reason="task timeout", force=True)
+                return "timeout", f"no result after {self.task_timeout} sec"
+            status, result, rss_mb = self.conn.recv()
+        except (EOFError, BrokenPipeError, OSError) as e:
+            self.process.join(timeout=5)
+            exitcode = self.process.exitcode
+            self.recycle()
+            return "crashed", f"worker died (exitcode {exitcode}): {type(e).__name__} {e}"
+
+        self.tasks_done = self.tasks_done + 1
+        self.last_rss_mb = rss_mb
+        if self.tasks_done >= self.max_tasks:
+            self.recycle(reason=f"done {self.tasks_done} tasks")
+        elif rss_mb > self.max_rss_mb:
+            self.recycle(reason=f"rss {rss_mb:.0f} MB > {self.max_rss_mb:.0f} MB")
+        return status, result
+
+
+    def submit(self, task, label=None, details=None):
+        """
+        details [optional]
+            dict saved in the dead-letter record, to find and replay the task later
+            (eg. candid and path of the dumped alert) - tasks themselves can be huge.
+        """
+        failures = []
+        for attempt in range(1 + self.max_retries):
+            status, result = self._run_once(task)
+            if status == "ok":
+                return result
+            logger.warning(f"task {label} attempt {attempt+1} {status}:\n{result}")
+            failures.append({"attempt": attempt + 1, "status": status, "details": result})
+            # start the retry from a clean worker - don't trust whatever state is left.
+            self.recycle(reason=f"task {status}")
+        dead_letter_file = self.dead_letter(label, failures, details=details)
+        raise WorkerTaskError(
+            f"task {label} failed {len(failures)} times, see {dead_letter_file}"
+        )
+
+
+    def dead_letter(self, label, failures, details=None):
+        self.dead_letter_path.mkdir(exist_ok=True, parents=True)
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        dead_letter_file = self.dead_letter_path / f"{label}_{timestamp}.json"
+        record = {
+            "label": label,
+            "timestamp": timestamp,
+            "details": details or {},
+            "failures": failures,
+        }
+        with open(dead_letter_file, "w") as f:
+            json.dump(record, f, indent=2, default=str)
+        logger.error(f"dead-lettered task {label} to {dead_letter_file}")
+        return dead_letter_file